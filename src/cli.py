@@ -1,17 +1,140 @@
 import argparse
+import logging
+import os
 
+from p6_converter.archive import convert_archive
+from p6_converter.archive import is_archive
+from p6_converter.batch import DEFAULT_MAX_WORKER_RSS
+from p6_converter.batch import DEFAULT_MEMORY_BUDGET
+from p6_converter.batch import load_history
+from p6_converter.batch import run_batch
+from p6_converter.batch import save_history
+from p6_converter.citations import CitationIndex
 from p6_converter.converter import Converter
+from p6_converter.converter import load_source
 from p6_converter.converter import preconvert
+from p6_converter.prescan import scan
+
+LOGGER = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(
                     prog='Epidoc Conversion',
                     description='Script to help with cleaning up Epidoc XML files',
                     epilog='')
 
-parser.add_argument('filename')
+parser.add_argument('filenames', nargs='+', metavar='filename')
+parser.add_argument('-o', '--output',
+                    help='Archive to write converted members to when FILENAME is a .zip, .tar or .tar.gz archive')
+parser.add_argument('--compress-level', type=int, default=None,
+                    help='Compression level for the output archive')
+parser.add_argument('-j', '--workers', type=int, default=None,
+                    help='Number of worker processes for batch conversion')
+parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET // 2**20,
+                    help='Approximate memory budget for batch conversion, in MiB')
+parser.add_argument('--max-worker-rss', type=int, default=DEFAULT_MAX_WORKER_RSS // 2**20,
+                    help='Recycle batch workers whose resident set grows beyond this many MiB')
+parser.add_argument('--history',
+                    help='JSON file of per-file timings used to schedule batch runs; updated after each run')
+parser.add_argument('--force', action='store_true',
+                    help='Run every pass on every file, even if a pre-scan finds nothing for it to do')
+parser.add_argument('--minimal-diff', action='store_true',
+                    help='Only rewrite the parts of each file that changed, keeping all other formatting as is')
+parser.add_argument('--index',
+                    help='SQLite citation index to update with the citations in each converted file')
+
+cited_by_parser = argparse.ArgumentParser(
+                    prog='Cited by',
+                    description='Look up the passages that cite a CTS URN in a citation index',
+                    epilog='')
+
+cited_by_parser.add_argument('index')
+cited_by_parser.add_argument('urn')
+cited_by_parser.add_argument('--exact', action='store_true',
+                             help='Only match citations of exactly this URN, not of URNs starting with it')
 
 def convert():
     args = parser.parse_args()
-    preconvert(args.filename)
-    converter = Converter(args.filename)
-    converter.convert()
+
+    if any(is_archive(filename) for filename in args.filenames):
+        if len(args.filenames) > 1:
+            parser.error('only one archive can be converted at a time')
+
+        if args.output is None:
+            parser.error('--output is required when converting an archive')
+
+        if not is_archive(args.output):
+            parser.error('--output must be a .zip, .tar or .tar.gz archive')
+
+        convert_archive(
+            args.filenames[0],
+            args.output,
+            compresslevel=args.compress_level,
+            prescan=not args.force,
+            minimal_diff=args.minimal_diff,
+            index=args.index,
+        )
+        return
+
+    if len(args.filenames) > 1 or args.workers is not None:
+        history = load_history(args.history) if args.history else None
+        report = run_batch(
+            args.filenames,
+            workers=args.workers,
+            memory_budget=args.memory_budget * 2**20,
+            history=history,
+            max_worker_rss=args.max_worker_rss * 2**20,
+            prescan=not args.force,
+            minimal_diff=args.minimal_diff,
+            index=args.index,
+        )
+        LOGGER.info(report.summary())
+
+        if args.history:
+            save_history(args.history, history, report.timings)
+
+        return
+
+    filename = args.filenames[0]
+    skip = ()
+    write = True
+
+    if not args.force:
+        plan = scan(filename)
+
+        if plan.empty:
+            LOGGER.info(f"{filename} needs no changes")
+
+            if args.index is None:
+                return
+
+            write = False
+
+        skip = plan.skip()
+
+    if args.minimal_diff:
+        # preconvert() would rewrite the whole file in text mode,
+        # so replace the entities in memory instead.
+        with open(filename, 'rb') as f:
+            converter = load_source(filename, f.read(), minimal_diff=True)
+    else:
+        if write:
+            preconvert(filename)
+
+        converter = Converter(filename)
+
+    converter.convert(write=write, skip=skip)
+
+    if args.index is not None:
+        with CitationIndex(args.index) as index:
+            index.update(filename, converter.find_citations())
+
+def cited_by():
+    args = cited_by_parser.parse_args()
+
+    if not os.path.exists(args.index):
+        cited_by_parser.error(f'{args.index} does not exist')
+
+    with CitationIndex(args.index) as index:
+        for document, passage, target, filename in index.cited_by(args.urn, exact=args.exact):
+            source = f'{document}:{passage}' if passage else document
+            print(f'{source}\t{target}\t{filename}')
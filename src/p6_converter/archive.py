@@ -0,0 +1,278 @@
+from datetime import datetime
+
+import io
+import logging
+import stat
+import tarfile
+import zipfile
+
+from .citations import CitationIndex
+from .converter import load_source
+from .prescan import scan_bytes
+
+LOGGER = logging.getLogger(__name__)
+
+TAR_SUFFIXES = {
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+}
+
+ZIP_SUFFIXES = (".zip",)
+
+# Zip timestamps cannot predate the DOS epoch.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def archive_format(path: str):
+    """
+    Return `"zip"`, `"tar"` or `"tar.gz"` depending on the
+    suffix of `path`, or `None` if `path` does not look like
+    a corpus archive.
+    """
+
+    lowered = path.lower()
+
+    if lowered.endswith(ZIP_SUFFIXES):
+        return "zip"
+
+    for suffix, compression in TAR_SUFFIXES.items():
+        if lowered.endswith(suffix):
+            return "tar.gz" if compression else "tar"
+
+    return None
+
+
+def is_archive(path: str) -> bool:
+    return archive_format(path) is not None
+
+
+def iter_members(path: str):
+    """
+    Yield `(info, data)` for every member of the archive at
+    `path`, where `info` is the archive's own `ZipInfo` or
+    `TarInfo`. `data` is `None` for members that are not regular
+    files, such as directories or links. Tar archives are read
+    as a stream, so members are never extracted to disk or
+    seeked over.
+    """
+
+    if archive_format(path) == "zip":
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    yield info, None
+                else:
+                    yield info, archive.read(info)
+    else:
+        with tarfile.open(path, mode="r|*") as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info, archive.extractfile(info).read()
+                else:
+                    yield info, None
+
+
+def convert_member(
+    name: str, data: bytes, prescan=True, minimal_diff=False, index=False
+):
+    """
+    Return the converted data of the member `name` and, with
+    `index`, its citations (or `None` if they are unknown).
+    """
+
+    if not name.endswith(".xml"):
+        return data, None
+
+    try:
+        skip = ()
+        write = True
+
+        if prescan:
+            plan = scan_bytes(data)
+
+            if plan.empty:
+                LOGGER.info(f"{name} needs no changes")
+
+                if not index:
+                    return data, None
+
+                if not plan.bibls:
+                    return data, []
+
+                write = False
+
+            skip = plan.skip()
+
+        converter = load_source(name, data, minimal_diff=minimal_diff)
+        converter.convert(write=False, skip=skip)
+
+        output = converter.tostring() if write else data
+        citations = converter.find_citations() if index else None
+
+        return output, citations
+    except Exception:
+        LOGGER.exception(f"Could not convert {name}; copying it unchanged")
+        return data, None
+
+
+def convert_archive(
+    source: str,
+    destination: str,
+    compresslevel=None,
+    prescan=True,
+    minimal_diff=False,
+    index=None,
+):
+    """
+    Convert every XML member of the archive at `source` and write
+    the results to a new archive at `destination`. Members that are
+    not XML, or that fail to convert, are copied unchanged, and so
+    are directories and links as far as the destination's format
+    can hold them (see `write_archive()`).
+
+    Members are converted in memory, and the output archive is
+    written in a single sequential pass once all of them are ready.
+    `compresslevel` is handed to `zipfile` or `tarfile` as is.
+    With `prescan`, members that need no changes are copied as they
+    are instead of being parsed and reserialized. `minimal_diff` is
+    handed on to `Converter`. With `index`, the path to a SQLite
+    `CitationIndex`, each member's citations are indexed under its
+    name in the archive.
+    """
+
+    members = []
+    citation_index = CitationIndex(index) if index else None
+
+    try:
+        for info, data in iter_members(source):
+            if data is None:
+                members.append((info, None))
+                continue
+
+            name = member_name(info)
+            LOGGER.info(f"Converting {name}")
+
+            output, citations = convert_member(
+                name,
+                data,
+                prescan=prescan,
+                minimal_diff=minimal_diff,
+                index=citation_index is not None,
+            )
+            members.append((info, output))
+
+            if citations is not None:
+                citation_index.update(name, citations)
+    finally:
+        if citation_index is not None:
+            citation_index.close()
+
+    write_archive(destination, members, compresslevel=compresslevel)
+
+    return len(members)
+
+
+def member_name(info) -> str:
+    if isinstance(info, zipfile.ZipInfo):
+        return info.filename
+
+    return info.name
+
+
+def write_archive(destination: str, members, compresslevel=None):
+    """
+    Write `members`, `(info, data)` pairs as yielded by
+    `iter_members()`, to a new archive at `destination`.
+    Directories are kept in either format. Links and other
+    special tar members can only be kept in a tar archive;
+    they are dropped from a zip archive with a warning.
+    """
+
+    fmt = archive_format(destination)
+
+    if fmt is None:
+        raise ValueError(f"Unsupported archive format: {destination}")
+
+    if fmt == "zip":
+        with zipfile.ZipFile(
+            destination,
+            mode="w",
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=compresslevel,
+        ) as archive:
+            for info, data in members:
+                if data is None:
+                    if not is_directory(info):
+                        LOGGER.warning(
+                            f"Dropping {member_name(info)}: zip archives cannot hold "
+                            "links or special files"
+                        )
+                        continue
+
+                    archive.mkdir(to_zipinfo(info))
+                    continue
+
+                archive.writestr(to_zipinfo(info), data, compresslevel=compresslevel)
+    else:
+        mode = "w:gz" if fmt == "tar.gz" else "w"
+        kwargs = {} if compresslevel is None or fmt == "tar" else {"compresslevel": compresslevel}
+
+        with tarfile.open(destination, mode=mode, **kwargs) as archive:
+            for info, data in members:
+                tarinfo = to_tarinfo(info)
+
+                if data is None:
+                    archive.addfile(tarinfo)
+                    continue
+
+                tarinfo.size = len(data)
+                archive.addfile(tarinfo, io.BytesIO(data))
+
+
+def is_directory(info) -> bool:
+    if isinstance(info, zipfile.ZipInfo):
+        return info.is_dir()
+
+    return info.isdir()
+
+
+def to_tarinfo(info) -> tarfile.TarInfo:
+    if isinstance(info, tarfile.TarInfo):
+        return info
+
+    tarinfo = tarfile.TarInfo(info.filename.rstrip("/"))
+    tarinfo.mtime = int(datetime(*info.date_time).timestamp())
+
+    if info.is_dir():
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+
+    return tarinfo
+
+
+def to_zipinfo(info) -> zipfile.ZipInfo:
+    if isinstance(info, zipfile.ZipInfo):
+        zipinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+        # Keeps file modes, and with them zip-style symlinks.
+        zipinfo.external_attr = info.external_attr
+    else:
+        date_time = datetime.fromtimestamp(info.mtime).timetuple()[:6]
+        name = f"{info.name}/" if info.isdir() else info.name
+        zipinfo = zipfile.ZipInfo(name, date_time=max(date_time, ZIP_EPOCH))
+
+        if info.isdir():
+            # The Unix mode and the MS-DOS directory flag.
+            zipinfo.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10
+
+    if zipinfo.is_dir():
+        # `ZipFile.mkdir()` writes these as they are.
+        zipinfo.file_size = 0
+        zipinfo.compress_size = 0
+        zipinfo.CRC = 0
+    else:
+        zipinfo.compress_type = zipfile.ZIP_DEFLATED
+
+    return zipinfo
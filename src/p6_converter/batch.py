@@ -0,0 +1,681 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+
+import json
+import logging
+import os
+import queue
+import resource
+import sqlite3
+import sys
+import threading
+import time
+
+from .citations import CitationIndex
+from .converter import load_source
+from .minimal_diff import first_difference, write_from
+from .prescan import scan_bytes
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKER_RSS = 1024 * 1024 * 1024
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+
+DEFAULT_PREFETCH = 8
+
+# A rough ratio between a document's size on disk and the memory
+# needed to hold its raw bytes, its parsed tree and its serialization
+# at the same time. lxml trees are considerably larger than the XML
+# they were parsed from.
+MEMORY_FACTOR = 8
+
+# How often, in seconds, a stage that is waiting on a queue checks
+# whether another stage has failed.
+POLL_INTERVAL = 0.1
+
+
+@dataclass
+class StageStats:
+    """
+    Counters for one stage of `run_batch()`. `max_queue_depth`
+    is the deepest that the queue feeding the stage got.
+    """
+
+    items: int = 0
+    bytes: int = 0
+    busy: float = 0.0
+    max_queue_depth: int = 0
+
+    def throughput(self) -> float:
+        """Bytes per second of time spent working in this stage."""
+
+        return self.bytes / self.busy if self.busy > 0 else 0.0
+
+
+@dataclass
+class BatchReport:
+    prefetch: StageStats = field(default_factory=StageStats)
+    convert: StageStats = field(default_factory=StageStats)
+    write: StageStats = field(default_factory=StageStats)
+    failed: list = field(default_factory=list)
+    unchanged: int = 0
+    indexed: int = 0
+    elapsed: float = 0.0
+    peak_memory: int = 0
+    makespan: float = 0.0
+    makespan_lower_bound: float = 0.0
+    recycled_pools: int = 0
+    timings: dict = field(default_factory=dict)
+
+    def summary(self) -> str:
+        lines = [
+            f"Converted {self.write.items} file(s) in {self.elapsed:.2f}s, "
+            f"{self.unchanged} needed no changes, {self.indexed} indexed, "
+            f"{len(self.failed)} failed, estimated peak memory {self.peak_memory} bytes",
+            f"makespan {self.makespan:.2f}s against a lower bound of "
+            f"{self.makespan_lower_bound:.2f}s, worker pool recycled "
+            f"{self.recycled_pools} time(s)",
+        ]
+
+        for name in ("prefetch", "convert", "write"):
+            stats = getattr(self, name)
+            lines.append(
+                f"{name}: {stats.items} file(s), {stats.bytes} bytes, "
+                f"{stats.busy:.2f}s busy, {stats.throughput():.0f} bytes/s, "
+                f"max queue depth {stats.max_queue_depth}"
+            )
+
+        return "\n".join(lines)
+
+
+class MemoryBudget:
+    """
+    Blocks callers of `acquire()` until the estimated memory in
+    flight leaves room for them. A single file larger than the
+    whole budget is let through on its own, so that it cannot
+    stall the batch forever.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, n: int):
+        with self.condition:
+            while self.used > 0 and self.used + n > self.limit:
+                self.condition.wait()
+
+            self.used += n
+            self.peak = max(self.peak, self.used)
+
+    def release(self, n: int):
+        with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
+
+def convert_timed(
+    filename: str, raw: bytes, prescan=True, minimal_diff=False, index=False
+):
+    """
+    Worker entry point: convert `raw` and report how long
+    the CPU-bound part took and how large the worker's
+    resident set is afterwards. The output is `(offset, data)`,
+    the bytes to write from the first one that changed, or `None`
+    if nothing did. With `index`, the converted document's
+    citations are returned as well.
+
+    With `prescan`, the file's `Plan` is worked out here rather
+    than in the prefetch stage, so that it runs in parallel. The
+    last value returned tells whether the plan was empty; such a
+    file is only parsed if its citations need to be indexed.
+    """
+
+    start = time.perf_counter()
+    skip = ()
+    write = True
+    unchanged = False
+
+    if prescan:
+        plan = scan_bytes(raw)
+        skip = plan.skip()
+
+        if plan.empty:
+            unchanged = True
+            write = False
+
+            if not index or not plan.bibls:
+                # Nothing to parse, but with `index` anything
+                # indexed for the file before is out of date.
+                citations = [] if index else None
+                seconds = time.perf_counter() - start
+
+                return None, seconds, current_rss(), citations, unchanged
+
+    converter = load_source(filename, raw, minimal_diff=minimal_diff)
+    converter.convert(write=False, skip=skip)
+
+    output = None
+
+    if write:
+        serialized = converter.tostring()
+
+        if serialized != raw:
+            offset = first_difference(raw, serialized)
+            output = (offset, serialized[offset:])
+
+    citations = converter.find_citations() if index else None
+    seconds = time.perf_counter() - start
+
+    return output, seconds, current_rss(), citations, unchanged
+
+
+def current_rss() -> int:
+    """
+    The resident set size of the current process in bytes. Falls
+    back to the peak RSS where `/proc` is not available.
+    """
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def corpus_rate(history=None):
+    """
+    The average number of seconds per byte over every timing in
+    `history`, or `None` if it has nothing to go by.
+    """
+
+    if not history:
+        return None
+
+    total_bytes = sum(timing["bytes"] for timing in history.values())
+    total_seconds = sum(timing["seconds"] for timing in history.values())
+
+    if total_bytes == 0:
+        return None
+
+    return total_seconds / total_bytes
+
+
+def estimate_cost(filename: str, size: int, history=None, rate=None) -> float:
+    """
+    Estimate how long `filename` will take to convert. If `history`
+    (a mapping of filenames to the `{"bytes": ..., "seconds": ...}`
+    timings of a previous run, see `BatchReport.timings`) knows the
+    file, its last timing is used; otherwise the cost is scaled from
+    the file's size by `rate`, which defaults to `corpus_rate(history)`.
+    Without a history the size itself serves as the estimate, which
+    is enough to order files.
+    """
+
+    if not history:
+        return float(size)
+
+    if filename in history:
+        return history[filename]["seconds"]
+
+    if rate is None:
+        rate = corpus_rate(history)
+
+    if rate is None:
+        return float(size)
+
+    return size * rate
+
+
+def load_history(path: str) -> dict:
+    """
+    Load the per-file timings saved by `save_history()`. A missing
+    history file is treated as an empty history.
+    """
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def makespan_lower_bound(durations, workers: int) -> float:
+    """
+    No schedule can finish before the longest single job, nor
+    before the total work spread evenly over every worker.
+    """
+
+    if len(durations) == 0:
+        return 0.0
+
+    return max(max(durations), sum(durations) / workers)
+
+
+def save_history(path: str, history: dict, timings: dict):
+    """
+    Merge the `timings` of a finished run into `history` and save
+    the result to `path` for the next run's scheduler.
+    """
+
+    history = {**history, **timings}
+
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2, sort_keys=True)
+
+
+def schedule(filenames, history=None):
+    """
+    Order `filenames` largest-first by estimated cost, so that
+    the biggest files start early and the small ones fill in
+    the gaps at the end of the run. Returns `(filename, size)`
+    pairs; files that cannot be stat'ed are left for the
+    prefetch stage to report.
+    """
+
+    sized = []
+    rate = corpus_rate(history)
+
+    for filename in filenames:
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = 0
+
+        sized.append((estimate_cost(filename, size, history, rate), filename, size))
+
+    sized.sort(key=lambda job: job[0], reverse=True)
+
+    return [(filename, size) for _, filename, size in sized]
+
+
+def prefetch_files(jobs, read_queue, budget, report, stop=None):
+    """
+    Read upcoming files ahead of the workers. Each file reserves
+    its estimated peak memory before it is read and keeps it until
+    its output has been written. Setting `stop` makes it give up
+    early. The `None` that ends the queue is posted even if reading
+    fails.
+    """
+
+    stats = report.prefetch
+    stop = stop or threading.Event()
+
+    try:
+        for filename, size in jobs:
+            if stop.is_set():
+                break
+
+            cost = size * MEMORY_FACTOR
+            budget.acquire(cost)
+            queued = False
+
+            try:
+                if stop.is_set():
+                    break
+
+                start = time.perf_counter()
+
+                try:
+                    with open(filename, "rb") as f:
+                        raw = f.read()
+                except OSError:
+                    LOGGER.exception(f"Could not read {filename}")
+                    report.failed.append(filename)
+                    continue
+
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+                stats.bytes += len(raw)
+
+                queued = put_until_stopped(read_queue, (filename, raw, cost), stop)
+                report.convert.max_queue_depth = max(
+                    report.convert.max_queue_depth, read_queue.qsize()
+                )
+            finally:
+                if not queued:
+                    budget.release(cost)
+    finally:
+        read_queue.put(None)
+
+
+def put_until_stopped(destination, item, stop) -> bool:
+    """
+    Put `item` on the bounded queue `destination`, unless `stop`
+    is set while waiting for room. Returns whether it was put.
+    """
+
+    while not stop.is_set():
+        try:
+            destination.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def get_until_stopped(source, stop):
+    """
+    Take the next item from `source`, or `None` if `stop`
+    is set while waiting for one.
+    """
+
+    while not stop.is_set():
+        try:
+            return source.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+
+    return None
+
+
+def release_queued(source, budget):
+    """
+    Empty `source` without waiting, releasing the memory
+    that its items had reserved.
+    """
+
+    while True:
+        try:
+            item = source.get_nowait()
+        except queue.Empty:
+            return
+
+        if item is None:
+            continue
+
+        budget.release(item[2])
+
+        if isinstance(item[-1], Future):
+            item[-1].cancel()
+
+
+def write_outputs(write_queue, budget, report, governor, citation_index=None):
+    """
+    Wait for each conversion in submission order and write
+    its output back to the original file. With `citation_index`,
+    each file's citations are recorded in it as well; this stage
+    is the only one that uses it.
+    """
+
+    while True:
+        item = write_queue.get()
+
+        if item is None:
+            break
+
+        filename, raw_size, cost, future = item
+
+        try:
+            write_output(filename, raw_size, future, report, governor, citation_index)
+        finally:
+            budget.release(cost)
+
+
+def write_output(filename, raw_size, future, report, governor, citation_index):
+    try:
+        output, seconds, rss, citations, unchanged = future.result()
+    except BrokenProcessPool:
+        LOGGER.error(f"A worker died while {filename} was pending; not converting it")
+        report.failed.append(filename)
+        return
+    except Exception:
+        LOGGER.exception(f"Could not convert {filename}")
+        report.failed.append(filename)
+        return
+    finally:
+        governor.finished = time.perf_counter()
+
+    report.convert.busy += seconds
+    report.convert.items += 1
+    report.convert.bytes += raw_size
+    report.timings[filename] = {"bytes": raw_size, "seconds": seconds}
+
+    if unchanged:
+        LOGGER.info(f"{filename} needs no changes")
+        report.unchanged += 1
+
+    if citation_index is not None and citations is not None:
+        try:
+            citation_index.update(filename, citations)
+        except sqlite3.Error:
+            LOGGER.exception(f"Could not index the citations in {filename}")
+            report.failed.append(filename)
+        else:
+            report.indexed += 1
+
+    if governor.max_worker_rss is not None and rss > governor.max_worker_rss:
+        LOGGER.info(
+            f"A worker grew to {rss} bytes after {filename}; recycling the pool"
+        )
+        governor.recycle.set()
+
+    if output is None:
+        return
+
+    offset, data = output
+    start = time.perf_counter()
+
+    try:
+        write_from(filename, offset, data)
+    except OSError:
+        LOGGER.exception(f"Could not write {filename}")
+        report.failed.append(filename)
+    else:
+        report.write.busy += time.perf_counter() - start
+        report.write.items += 1
+        report.write.bytes += len(data)
+
+
+class Governor:
+    """
+    State shared between the dispatcher and the write-behind stage:
+    whether the worker pool has grown too large and should be
+    replaced, and when the last conversion finished.
+    """
+
+    def __init__(self, max_worker_rss=None):
+        self.max_worker_rss = max_worker_rss
+        self.recycle = threading.Event()
+        self.finished = None
+
+
+class Stage(threading.Thread):
+    """
+    A thread running one stage of `run_batch()`. If the stage
+    raises, the exception is kept in `error` and `stop` is set,
+    so that the other stages give up instead of waiting for it.
+    """
+
+    def __init__(self, name, target, args, stop):
+        super().__init__(name=name, target=target, args=args)
+        self.stop = stop
+        self.error = None
+
+    def run(self):
+        try:
+            super().run()
+        except BaseException as error:
+            LOGGER.exception(f"The {self.name} stage failed")
+            self.error = error
+            self.stop.set()
+
+
+def run_batch(
+    filenames,
+    workers=None,
+    memory_budget=DEFAULT_MEMORY_BUDGET,
+    prefetch=DEFAULT_PREFETCH,
+    history=None,
+    max_worker_rss=DEFAULT_MAX_WORKER_RSS,
+    prescan=True,
+    minimal_diff=False,
+    index=None,
+) -> BatchReport:
+    """
+    Convert `filenames` in place with a three-stage pipeline:
+    a prefetch thread reads files ahead of time, a process pool
+    runs the `Converter` passes, and a write-behind thread writes
+    the results. The queues between the stages are bounded, and
+    files are only read once their estimated memory fits in
+    `memory_budget` bytes, so a slow stage holds the others back
+    instead of letting memory grow.
+
+    Files are dispatched largest-first (see `schedule()`). When a
+    worker reports a resident set larger than `max_worker_rss`
+    bytes, the pool is replaced by a fresh one once its pending
+    work is done; pass `None` to never recycle it.
+
+    With `prescan`, each worker first checks its file with
+    `prescan.scan_bytes()`: files that need no changes are left
+    alone, and the others only run the passes their plan calls for.
+    `minimal_diff` is handed on to `Converter`.
+
+    With `index`, the path to a SQLite `CitationIndex`, the citations
+    of every file are indexed as part of the same run. Files that need
+    no changes are still parsed if they have any `<bibl>`s, but they
+    are not written.
+
+    If the prefetch or write-behind stage fails, the other stages
+    are stopped and its exception is raised once they have exited.
+    """
+
+    # Opened before any thread starts, so that a bad path
+    # fails here rather than in the write-behind stage.
+    citation_index = CitationIndex(index, check_same_thread=False) if index else None
+
+    workers = workers or os.cpu_count() or 1
+    report = BatchReport()
+    budget = MemoryBudget(memory_budget)
+    governor = Governor(max_worker_rss)
+    read_queue = queue.Queue(maxsize=prefetch)
+    write_queue = queue.Queue(maxsize=workers * 2)
+
+    start = time.perf_counter()
+    dispatched = None
+    stop = threading.Event()
+
+    prefetcher = Stage(
+        "prefetch",
+        prefetch_files,
+        (
+            schedule(filenames, history),
+            read_queue,
+            budget,
+            report,
+            stop,
+        ),
+        stop,
+    )
+    writer = Stage(
+        "write-behind",
+        write_outputs,
+        (write_queue, budget, report, governor, citation_index),
+        stop,
+    )
+    prefetcher.start()
+    writer.start()
+
+    executors = [ProcessPoolExecutor(max_workers=workers)]
+
+    try:
+        while True:
+            item = get_until_stopped(read_queue, stop)
+
+            if item is None:
+                break
+
+            if governor.recycle.is_set():
+                governor.recycle.clear()
+                # Let the old workers finish and exit first, so that
+                # there are never more than `workers` processes.
+                executors[-1].shutdown()
+                executors.append(ProcessPoolExecutor(max_workers=workers))
+                report.recycled_pools += 1
+
+            filename, raw, cost = item
+            job = (
+                convert_timed,
+                filename,
+                raw,
+                prescan,
+                minimal_diff,
+                index is not None,
+            )
+
+            try:
+                future = executors[-1].submit(*job)
+            except BrokenProcessPool:
+                # A worker died, e.g. because it was killed for using too
+                # much memory. The files it had pending fail in the
+                # write-behind stage; this one gets a fresh pool.
+                LOGGER.error(f"The worker pool broke before {filename}; starting a new one")
+                executors.append(ProcessPoolExecutor(max_workers=workers))
+                future = executors[-1].submit(*job)
+
+            if dispatched is None:
+                dispatched = time.perf_counter()
+
+            if not put_until_stopped(write_queue, (filename, len(raw), cost, future), stop):
+                future.cancel()
+                budget.release(cost)
+                break
+
+            report.write.max_queue_depth = max(
+                report.write.max_queue_depth, write_queue.qsize()
+            )
+    finally:
+        stop.set()
+
+        # The write-behind stage may have died with its queue full.
+        while writer.is_alive():
+            try:
+                write_queue.put(None, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+
+        writer.join()
+
+        # Anything it left behind still holds memory that the
+        # prefetch stage may be waiting for.
+        release_queued(write_queue, budget)
+
+        # If the loop above stopped early, the prefetch stage may be
+        # blocked on the full read queue or on the memory budget, so
+        # keep draining until it has given up.
+        while prefetcher.is_alive():
+            release_queued(read_queue, budget)
+            prefetcher.join(POLL_INTERVAL)
+
+        release_queued(read_queue, budget)
+
+        for executor in executors:
+            executor.shutdown()
+
+        if citation_index is not None:
+            citation_index.close()
+
+    for stage in (prefetcher, writer):
+        if stage.error is not None:
+            raise stage.error
+
+    report.elapsed = time.perf_counter() - start
+    report.peak_memory = budget.peak
+
+    if dispatched is not None and governor.finished is not None:
+        report.makespan = governor.finished - dispatched
+
+    report.makespan_lower_bound = makespan_lower_bound(
+        [timing["seconds"] for timing in report.timings.values()], workers
+    )
+
+    return report
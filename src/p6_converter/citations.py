@@ -0,0 +1,108 @@
+import logging
+import sqlite3
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS citations (
+    filename TEXT NOT NULL,
+    document TEXT NOT NULL,
+    passage TEXT NOT NULL,
+    target TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS citations_by_target ON citations (target);
+CREATE INDEX IF NOT EXISTS citations_by_filename ON citations (filename);
+"""
+
+# What may follow a URN inside a longer one that it is a prefix of:
+# the passage after the work, a deeper level of the passage, or the
+# end of a range.
+URN_SEPARATORS = (":", ".", "-")
+
+
+def prefix_upper_bound(prefix: str) -> str:
+    """
+    The smallest string that sorts after every string starting
+    with `prefix`, so that a prefix search becomes a range scan
+    over the index instead of a `LIKE` over the whole table.
+    """
+
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class CitationIndex:
+    """
+    An on-disk SQLite index of the citations found by
+    `Converter.find_citations()`, for reverse lookups such as
+    "which commentary passages cite Soph. OC 437?".
+    """
+
+    def __init__(self, path: str, check_same_thread=True):
+        """
+        Pass `check_same_thread=False` to hand the index to another
+        thread than the one that opened it; only one thread may use
+        it at a time.
+        """
+
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=check_same_thread)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, filename: str, citations):
+        """
+        Replace everything indexed for `filename` with `citations`,
+        a list of `(document, passage, target)` tuples, in a single
+        transaction.
+        """
+
+        LOGGER.debug(f"Indexing {len(citations)} citation(s) in {filename}")
+
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM citations WHERE filename = ?", (filename,)
+            )
+            self.connection.executemany(
+                "INSERT INTO citations (filename, document, passage, target)"
+                " VALUES (?, ?, ?, ?)",
+                [(filename, *citation) for citation in citations],
+            )
+
+    def cited_by(self, urn: str, exact=False):
+        """
+        Return the `(document, passage, target, filename)` of every
+        citation whose target is `urn` or, unless `exact`, starts
+        with it followed by one of `URN_SEPARATORS`.
+        `"urn:cts:greekLit:tlg0011.tlg007:437"` thus also finds
+        citations of `437-440` and `437.1`, but not of `4370`, and
+        the work-level URN finds citations of any passage in it.
+        """
+
+        if exact or len(urn) == 0:
+            where, params = "target = ?", (urn,)
+        elif urn.endswith(URN_SEPARATORS):
+            where, params = "target >= ? AND target < ?", (urn, prefix_upper_bound(urn))
+        else:
+            where = " OR ".join(
+                ["target = ?"] + ["(target >= ? AND target < ?)"] * len(URN_SEPARATORS)
+            )
+            params = [urn]
+
+            for separator in URN_SEPARATORS:
+                params += [urn + separator, prefix_upper_bound(urn + separator)]
+
+        return self.connection.execute(
+            "SELECT document, passage, target, filename FROM citations"
+            f" WHERE {where} ORDER BY target, document, passage",
+            params,
+        ).fetchall()
@@ -6,6 +6,13 @@ import logging
 import lxml.etree as etree
 
 from .character_entities import ENTITIES
+from .minimal_diff import (
+    apply_patches,
+    find_patches,
+    first_difference,
+    snapshot,
+    write_from,
+)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -37,11 +44,42 @@ NAMESPACES = {
 TEI_NS = "{http://www.tei-c.org/ns/1.0}"
 XML_NS = "{http://www.w3.org/XML/1998/namespace}"
 
+# Whitespace as XML defines it; `str.strip()` would also strip
+# characters like U+00A0 that are text as far as XML is concerned.
+XML_WHITESPACE = " \t\r\n"
+
 SKIPPABLE_MILESTONE_UNITS = (
     "pg_l",
     None,
 )
 
+# The passes run by `Converter.convert()`, in order.
+PASSES = (
+    "assign_refable_units",
+    "add_lang_and_urn_to_body_and_first_div",
+    "convert_lemma_to_applemma",
+    "convert_note_gloss_to_app",
+    "remove_div_pg_l",
+    "convert_argument_tags",
+    "convert_bylines",
+    "convert_dates",
+    "convert_langs",
+    # betacode to unicode needs to come after
+    # language attributes have been fixed
+    "convert_betacode_to_unicode",
+    "convert_milestones_to_textparts",
+    "pro_lege_manilia",
+    "convert_speeches",
+    "convert_summary_children_to_siblings",
+    "convert_overviews",
+    "convert_summaries",
+    "convert_sections",
+    # "number_textparts",
+    "remove_targOrder_attr",
+    # "uproot_smyth_parts",
+    "add_ref_to_bibls",
+)
+
 URN_SUBSTITUTIONS = {
     "Soph. OC": "urn:cts:greekLit:tlg0011.tlg007",
     "Soph. OT": "urn:cts:greekLit:tlg0011.tlg004",
@@ -79,6 +117,20 @@ def convert_citation(s: str) -> str:
     return s
 
 
+def convert_source(filename: str, raw: bytes, skip=(), minimal_diff=False) -> bytes:
+    """
+    Run the entity replacement, the `Converter` passes and
+    serialization over the raw bytes of a document without
+    touching the filesystem. `filename` is only used to
+    derive the document's URN.
+    """
+
+    converter = load_source(filename, raw, minimal_diff=minimal_diff)
+    converter.convert(write=False, skip=skip)
+
+    return converter.tostring()
+
+
 def derive_lang(tree):
     doc_languages = tree.xpath(".//tei:langUsage/tei:language", namespaces=NAMESPACES)
 
@@ -114,48 +166,84 @@ def fix_lang(s):
     return LANGUAGES.get(s, s)
 
 
+def load_source(filename: str, raw: bytes, minimal_diff=False):
+    """
+    Replace the character entities in `raw` and
+    build a `Converter` for the result.
+    """
+
+    source = replace_entities(raw.decode("utf-8")).encode("utf-8")
+
+    return Converter(filename, source=source, minimal_diff=minimal_diff, original=raw)
+
+
 def preconvert(filename):
     with open(filename, "r") as f:
         raw = f.read()
 
-    for entity, s in ENTITIES.items():
-        raw = raw.replace(entity, s)
+    raw = replace_entities(raw)
 
     with open(filename, "w") as f:
         f.write(raw)
 
 
+def replace_entities(raw: str) -> str:
+    """
+    Replace the named character entities in `ENTITIES`
+    with their Unicode equivalents. This is the in-memory
+    counterpart of `preconvert()`.
+    """
+
+    for entity, s in ENTITIES.items():
+        raw = raw.replace(entity, s)
+
+    return raw
+
+
 class Converter:
-    def __init__(self, filename):
-        parser = etree.XMLParser(remove_blank_text=True)
+    def __init__(self, filename, source=None, minimal_diff=False, original=None):
+        """
+        With `minimal_diff`, the output keeps every byte of the source
+        that the passes did not touch, instead of re-indenting and
+        reserializing the whole tree. Blank text is part of that
+        formatting, so it is not removed when parsing. `original` is
+        what is on disk, if `source` differs from it, e.g. because
+        `load_source()` replaced its entities.
+        """
+
+        parser = etree.XMLParser(remove_blank_text=not minimal_diff)
         self.filename = filename
-        self.tree = etree.parse(filename, parser=parser)
-
-    def convert(self):
-        self.assign_refable_units()
-        self.add_lang_and_urn_to_body_and_first_div()
-        self.convert_lemma_to_applemma()
-        self.convert_note_gloss_to_app()
-        self.remove_div_pg_l()
-        self.convert_argument_tags()
-        self.convert_bylines()
-        self.convert_dates()
-        self.convert_langs()
-        # betacode to unicode needs to come after
-        # language attributes have been fixed
-        self.convert_betacode_to_unicode()
-        self.convert_milestones_to_textparts()
-        self.pro_lege_manilia()
-        self.convert_speeches()
-        self.convert_summary_children_to_siblings()
-        self.convert_overviews()
-        self.convert_summaries()
-        self.convert_sections()
-        # self.number_textparts()
-        self.remove_targOrder_attr()
-        # self.uproot_smyth_parts()
-        self.add_ref_to_bibls()
-        self.write_etree()
+        self.minimal_diff = minimal_diff
+        self.original = original
+
+        if minimal_diff and source is None:
+            with open(filename, "rb") as f:
+                source = f.read()
+
+        if source is None:
+            self.tree = etree.parse(filename, parser=parser)
+        else:
+            self.tree = etree.ElementTree(etree.fromstring(source, parser=parser))
+
+        if minimal_diff:
+            self.source = source
+            self.states = snapshot(self.tree)
+
+    def convert(self, write=True, skip=()):
+        """
+        Run every pass in `PASSES` except those named in `skip`,
+        e.g. because `prescan.scan()` found nothing for them to do.
+        """
+
+        for name in PASSES:
+            if name in skip:
+                LOGGER.debug(f"Skipping {name}()")
+                continue
+
+            getattr(self, name)()
+
+        if write:
+            self.write_etree()
 
     def add_lang_and_urn_to_body_and_first_div(self):
         LOGGER.info("add_lang_and_urn_to_body_and_first_div() called")
@@ -289,7 +377,11 @@ class Converter:
                     if descendant.getparent().attrib.get(f"{XML_NS}lang") == "grc":
                         descendant.tail = conv.beta_to_uni(descendant.tail)
                     elif descendant.getparent().attrib.get(f"{XML_NS}lang") == "eng":
-                        descendant.tail = conv.uni_to_beta(descendant.text)
+                        # Leave whitespace-only tails alone, so that the
+                        # result does not depend on whether blank text
+                        # was kept when parsing (see `minimal_diff`).
+                        if descendant.tail.strip(XML_WHITESPACE) != "":
+                            descendant.tail = conv.uni_to_beta(descendant.text)
 
         for gap in self.tree.iterfind(f".//{TEI_NS}gap"):
             logging.info("Found a <gap> element -- checking parent for language")
@@ -573,7 +665,75 @@ class Converter:
                 part.addprevious(deepcopy(child))
             parent.remove(part)
 
+    def find_citations(self):
+        """
+        Return a `(document, passage, target)` tuple for every `<bibl>`
+        with a `@ref`, where `document` is the `@n` URN of the `<body>`
+        and `passage` joins the `@n`s of the textparts around the
+        `<bibl>`, outermost first, e.g. `"1.437"`. Run this after
+        `add_ref_to_bibls()`.
+        """
+
+        body = self.tree.find(".//tei:body", namespaces=NAMESPACES)
+        document = None if body is None else body.get("n")
+
+        if document is None:
+            LOGGER.warning(f"No URN found for {self.filename}; not indexing its citations")
+            return []
+
+        citations = []
+
+        for bibl in self.tree.iterfind(".//tei:bibl[@ref]", namespaces=NAMESPACES):
+            # `convert_argument_tags()` leaves `<div>`s without a namespace,
+            # so we can't match on the qualified tag here.
+            passage = [
+                ancestor.get("n", "")
+                for ancestor in bibl.iterancestors()
+                if etree.QName(ancestor).localname == "div"
+                and ancestor.get("type") == "textpart"
+            ]
+            citations.append((document, ".".join(reversed(passage)), bibl.get("ref")))
+
+        return citations
+
+    def find_patches(self):
+        """
+        The byte ranges of the source that the passes changed, or
+        `None` if the output has to be serialized from scratch.
+        """
+
+        if not self.minimal_diff:
+            return None
+
+        return find_patches(self.source, self.tree, self.states)
+
+    def tostring(self):
+        patches = self.find_patches()
+
+        if patches is not None:
+            return apply_patches(self.source, patches)
+
+        etree.indent(self.tree, space="\t")
+        return etree.tostring(self.tree, encoding="utf-8", xml_declaration=True)
+
     def write_etree(self):
+        patches = self.find_patches()
+
+        if patches is not None:
+            self.write_patches(patches)
+            return
+
         with open(self.filename, "wb") as f:
-            etree.indent(self.tree, space="\t")
-            f.write(etree.tostring(self.tree, encoding="utf-8", xml_declaration=True))
+            f.write(self.tostring())
+
+    def write_patches(self, patches):
+        original = self.source if self.original is None else self.original
+        output = apply_patches(self.source, patches)
+
+        if output == original:
+            LOGGER.info(f"No changes to write to {self.filename}")
+            return
+
+        # Everything before the first change is already on disk.
+        first = first_difference(original, output)
+        write_from(self.filename, first, output[first:])
@@ -0,0 +1,321 @@
+import logging
+import re
+
+import lxml.etree as etree
+
+LOGGER = logging.getLogger(__name__)
+
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+# Markup that does not produce an element is matched first,
+# so that a `<` inside a comment or CDATA section is never
+# mistaken for a tag.
+TOKEN_PATTERN = re.compile(
+    rb"<!--.*?-->"
+    rb"|<\?.*?\?>"
+    rb"|<!\[CDATA\[.*?\]\]>"
+    rb"|<!DOCTYPE(?:[^\[>]|\[.*?\])*>"
+    rb"|</[^>]*>"
+    rb"|<(?:[^>\"']|\"[^\"]*\"|'[^']*')*>",
+    re.DOTALL,
+)
+
+TAG_NAME_PATTERN = re.compile(rb"</?([^\s/>]+)")
+
+NAMESPACE_DECLARATION_PATTERN = re.compile(
+    rb"\s+xmlns(?::([\w.-]+))?\s*=\s*(?:\"([^\"]*)\"|'([^']*)')"
+)
+
+ATTRIBUTE_ESCAPES = {
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "\n": "&#10;",
+    "\r": "&#13;",
+    "\t": "&#9;",
+}
+
+
+class Span:
+    """
+    Byte offsets of an element's start tag and, unless
+    it is self-closing, its end tag in the source.
+    """
+
+    def __init__(self, start_tag, end_tag=None):
+        self.start_tag = start_tag
+        self.end_tag = end_tag
+
+    @property
+    def start(self):
+        return self.start_tag[0]
+
+    @property
+    def end(self):
+        return (self.end_tag or self.start_tag)[1]
+
+
+class State:
+    """What a node looked like before the passes ran."""
+
+    def __init__(self, node):
+        self.tag = node.tag
+        self.attrib = dict(node.attrib) if isinstance(node.tag, str) else {}
+        self.text = node.text
+        self.tail = node.tail
+        self.children = list(node)
+
+
+# Bytes compared at a time by `first_difference()`.
+COMPARISON_CHUNK_SIZE = 64 * 1024
+
+
+def apply_patches(raw: bytes, patches) -> bytes:
+    output = []
+    position = 0
+
+    for start, end, replacement in patches:
+        output.append(raw[position:start])
+        output.append(replacement)
+        position = end
+
+    output.append(raw[position:])
+
+    return b"".join(output)
+
+
+def element_spans(raw: bytes) -> list:
+    """
+    Scan `raw` for elements and return their `Span`s in document
+    order, which is the order of `tree.iter(etree.Element)`.
+    """
+
+    spans = []
+    open_elements = []
+
+    for token in TOKEN_PATTERN.finditer(raw):
+        text = token.group(0)
+
+        if text.startswith((b"<!", b"<?")):
+            continue
+
+        if text.startswith(b"</"):
+            span = open_elements.pop()
+            span.end_tag = token.span()
+            continue
+
+        span = Span(token.span())
+        spans.append((TAG_NAME_PATTERN.match(text).group(1), span))
+
+        if not text.endswith(b"/>"):
+            open_elements.append(span)
+
+    return spans
+
+
+def escape_attribute(value: str) -> str:
+    return "".join(ATTRIBUTE_ESCAPES.get(c, c) for c in value)
+
+
+def first_difference(a: bytes, b: bytes) -> int:
+    """
+    The offset of the first byte where `a` and `b` differ, or
+    the length of the shorter one if it is a prefix of the other.
+    """
+
+    length = min(len(a), len(b))
+    offset = 0
+
+    while offset < length and a[offset : offset + COMPARISON_CHUNK_SIZE] == b[
+        offset : offset + COMPARISON_CHUNK_SIZE
+    ]:
+        offset += COMPARISON_CHUNK_SIZE
+
+    end = min(offset + COMPARISON_CHUNK_SIZE, length)
+
+    while offset < end and a[offset] == b[offset]:
+        offset += 1
+
+    return min(offset, length)
+
+
+def write_from(filename: str, offset: int, data: bytes):
+    """
+    Overwrite `filename` from `offset` onwards with `data`, leaving
+    the bytes before `offset` where they are on disk.
+    """
+
+    with open(filename, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+
+
+def local_name(name: bytes) -> str:
+    return name.split(b":")[-1].decode("utf-8")
+
+
+def qualified_name(el) -> str:
+    name = etree.QName(el).localname
+
+    if el.prefix:
+        return f"{el.prefix}:{name}"
+
+    return name
+
+
+def qualified_attribute(key: str, nsmap: dict):
+    qname = etree.QName(key)
+
+    if qname.namespace is None:
+        return qname.localname
+
+    if qname.namespace == XML_NAMESPACE:
+        return f"xml:{qname.localname}"
+
+    for prefix, uri in nsmap.items():
+        if prefix is not None and uri == qname.namespace:
+            return f"{prefix}:{qname.localname}"
+
+    return None
+
+
+def serialize_end_tag(el) -> bytes:
+    return f"</{qualified_name(el)}>".encode("utf-8")
+
+
+def serialize_start_tag(el, original: bytes):
+    """
+    Build a new start tag for `el`, keeping the namespace
+    declarations of the `original` start tag. Returns `None`
+    if an attribute's namespace has no prefix in scope.
+    """
+
+    parts = [f"<{qualified_name(el)}".encode("utf-8")]
+
+    for declaration in NAMESPACE_DECLARATION_PATTERN.finditer(original):
+        parts.append(declaration.group(0))
+
+    for key, value in el.attrib.items():
+        name = qualified_attribute(key, el.nsmap)
+
+        if name is None:
+            return None
+
+        parts.append(f' {name}="{escape_attribute(value)}"'.encode("utf-8"))
+
+    parts.append(b"/>" if original.endswith(b"/>") else b">")
+
+    return b"".join(parts)
+
+
+def serialize_element(el) -> bytes:
+    """
+    Serialize `el` without its tail, dropping the namespace
+    declarations that lxml repeats on its start tag although
+    they are already in scope at its parent.
+    """
+
+    serialized = etree.tostring(el, encoding="utf-8", with_tail=False)
+    parent = el.getparent()
+
+    if parent is None:
+        return serialized
+
+    in_scope = parent.nsmap
+    end = TOKEN_PATTERN.match(serialized).end()
+
+    def redundant(declaration):
+        prefix = declaration.group(1)
+        uri = declaration.group(2) if declaration.group(2) is not None else declaration.group(3)
+
+        if prefix is not None:
+            prefix = prefix.decode("utf-8")
+
+        if in_scope.get(prefix) == uri.decode("utf-8"):
+            return b""
+
+        return declaration.group(0)
+
+    start_tag = NAMESPACE_DECLARATION_PATTERN.sub(redundant, serialized[:end])
+
+    return start_tag + serialized[end:]
+
+
+def snapshot(tree) -> dict:
+    """
+    Record the state of every node in `tree` so that
+    `find_patches()` can tell later which ones the passes modified.
+    """
+
+    return {node: State(node) for node in tree.getroot().iter()}
+
+
+def find_patches(raw: bytes, tree, states: dict):
+    """
+    Compare `tree` against the `states` recorded by `snapshot()`
+    before the passes ran and return the `(start, end, replacement)`
+    patches that turn `raw` into the converted document.
+
+    An element whose text, tails or children changed is serialized
+    again as a whole; one whose tag or attributes changed only has
+    its start and end tags replaced. Everything else is left as it
+    is in `raw`. Returns `None` if the elements in `raw` cannot be
+    matched up with those in the tree, in which case the caller
+    should fall back to serializing the whole tree.
+    """
+
+    root = tree.getroot()
+
+    if root not in states:
+        return None
+
+    elements = [el for el in states if isinstance(el.tag, str)]
+    spans = element_spans(raw)
+
+    if len(spans) != len(elements):
+        LOGGER.warning("Could not match source elements to the tree")
+        return None
+
+    for el, (name, _) in zip(elements, spans):
+        if etree.QName(states[el].tag).localname != local_name(name):
+            LOGGER.warning("Could not match source elements to the tree")
+            return None
+
+    element_span = {el: span for el, (_, span) in zip(elements, spans)}
+    patches = []
+
+    def visit(el):
+        state = states[el]
+        children = list(el)
+        span = element_span[el]
+
+        if (
+            el.text != state.text
+            or children != state.children
+            or any(child.tail != states[child].tail for child in children)
+        ):
+            patches.append((span.start, span.end, serialize_element(el)))
+            return
+
+        if el.tag != state.tag or dict(el.attrib) != state.attrib:
+            start, end = span.start_tag
+            start_tag = serialize_start_tag(el, raw[start:end])
+
+            if start_tag is None:
+                patches.append((span.start, span.end, serialize_element(el)))
+                return
+
+            patches.append((start, end, start_tag))
+
+            if span.end_tag is not None and el.tag != state.tag:
+                patches.append((*span.end_tag, serialize_end_tag(el)))
+
+        for child in children:
+            if isinstance(child.tag, str):
+                visit(child)
+
+    visit(root)
+
+    return sorted(patches, key=lambda patch: patch[0])
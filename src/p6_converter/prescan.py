@@ -0,0 +1,423 @@
+from betacode import conv
+
+import mmap
+import re
+import string
+
+from .character_entities import ENTITIES
+from .converter import LANGUAGES, PASSES, XML_WHITESPACE, convert_citation
+
+LEGACY_LANGS = b"|".join(re.escape(lang.encode("utf-8")) for lang in LANGUAGES)
+
+ENTITY_PATTERN = re.compile(
+    b"|".join(re.escape(entity.encode("utf-8")) for entity in ENTITIES)
+)
+
+PASS_TRIGGERS = {
+    "convert_lemma_to_applemma": re.compile(rb"<lemma\b"),
+    "convert_note_gloss_to_app": re.compile(
+        rb"<note\b[^>]*\btype\s*=\s*[\"']gloss[\"']"
+    ),
+    "remove_div_pg_l": re.compile(rb"\bsubtype\s*=\s*[\"']pg_l[\"']"),
+    "convert_argument_tags": re.compile(rb"<argument\b"),
+    "convert_bylines": re.compile(rb"<byline\b"),
+    # `fix_date()` only changes years that are not yet zero-padded.
+    "convert_dates": re.compile(
+        rb"<dateRange\b"
+        rb"|<date\b[^>]*\svalue\s*="
+        rb"|<date\b[^>]*\swhen\s*=\s*[\"']-?\d{1,3}[\"']"
+    ),
+    "convert_langs": re.compile(
+        rb"\slang\s*="
+        rb"|xml:lang\s*=\s*[\"'](?:" + LEGACY_LANGS + rb")[\"']"
+        rb"|<language\b(?![^>]*\bident\s*=)"
+        rb"|<language\b[^>]*\bident\s*=\s*[\"'](?:" + LEGACY_LANGS + rb")[\"']"
+    ),
+    "convert_milestones_to_textparts": re.compile(rb"<milestone\b"),
+    "pro_lege_manilia": re.compile(rb"sec00009\.sec004"),
+    "convert_speeches": re.compile(rb"\btype\s*=\s*[\"']speech[\"']"),
+    "convert_summary_children_to_siblings": re.compile(
+        rb"\btype\s*=\s*[\"']overv[\"']"
+    ),
+    "convert_overviews": re.compile(rb"\btype\s*=\s*[\"']overv[\"']"),
+    "convert_summaries": re.compile(rb"\btype\s*=\s*[\"']summary[\"']"),
+    "convert_sections": re.compile(rb"\btype\s*=\s*[\"']section[\"']"),
+    "remove_targOrder_attr": re.compile(rb"\stargOrder\s*="),
+}
+
+# Passes that other passes rely on for state, such as
+# `self.refable_units` or `self.urn`.
+PASS_DEPENDENCIES = {
+    "convert_milestones_to_textparts": ("assign_refable_units",),
+    "pro_lege_manilia": ("add_lang_and_urn_to_body_and_first_div",),
+}
+
+ATTRIBUTE_PATTERN = re.compile(rb"([\w:.-]+)\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+BIBL_PATTERN = re.compile(rb"<bibl\b")
+
+BIBL_START_TAG_PATTERN = re.compile(rb"<bibl\b[^>]*>")
+
+BODY_PATTERN = re.compile(rb"<body\b[^>]*>")
+
+DIV_PATTERN = re.compile(rb"<div\b[^>]*>")
+
+LANGUAGE_PATTERN = re.compile(rb"<language\b[^>]*>")
+
+GREEK_START_TAG_PATTERN = re.compile(
+    rb"<([\w:.-]+)\b[^>]*?\blang\s*=\s*[\"'](?:grc|greek|gr)[\"'][^>]*?(/?)>"
+)
+
+ENGLISH_LANG_PATTERN = re.compile(rb"\blang\s*=\s*[\"'](?:eng|en)[\"']")
+
+ENTITY_REFERENCE_PATTERN = re.compile(rb"&[^;\s]*;")
+
+GREEK_LANG_PATTERN = re.compile(rb"\blang\s*=\s*[\"'](?:grc|greek|gr)[\"']")
+
+NON_ASCII_PATTERN = re.compile(rb"[^\x00-\x7f]")
+
+# Comments and processing instructions are matched whole, so that
+# they can be told apart from the text around them.
+NODE_PATTERN = re.compile(
+    rb"<!--(.*?)-->"
+    rb"|<\?.*?\?>"
+    rb"|<!\[CDATA\["
+    rb"|<(/?)[^\s/>]+((?:[^>\"']|\"[^\"]*\"|'[^']*')*?)(/?)>",
+    re.DOTALL,
+)
+
+# Characters that `betacode.conv.beta_to_uni()` rewrites. Diacritics
+# like `/` or `(` are only rewritten after a letter, so checking for
+# the characters that change on their own is enough.
+BETACODE_PATTERN = re.compile(
+    b"["
+    + re.escape(
+        "".join(c for c in string.printable if conv.beta_to_uni(c) != c).encode("utf-8")
+    )
+    + b"]"
+)
+
+
+class Plan:
+    """
+    The passes that a document needs, and whether its
+    character entities need to be replaced first. `bibls`
+    tells whether it has any citations to index.
+    """
+
+    def __init__(self, passes, entities=False, bibls=False):
+        self.passes = frozenset(passes)
+        self.entities = entities
+        self.bibls = bibls
+
+    def __repr__(self):
+        return (
+            f"Plan({sorted(self.passes)!r}, entities={self.entities!r}, "
+            f"bibls={self.bibls!r})"
+        )
+
+    @property
+    def empty(self) -> bool:
+        return len(self.passes) == 0 and not self.entities
+
+    def skip(self) -> frozenset:
+        """The passes that `Converter.convert()` can leave out."""
+
+        return frozenset(PASSES) - self.passes
+
+
+def attributes(start_tag: bytes) -> dict:
+    return {
+        match.group(1): match.group(2) if match.group(2) is not None else match.group(3)
+        for match in ATTRIBUTE_PATTERN.finditer(start_tag)
+    }
+
+
+def derived_body_lang(raw):
+    """
+    The language that `add_lang_and_urn_to_body_and_first_div()` would
+    give `<body>`: its own `@xml:lang`, or else the first `<language>`
+    declared in the header.
+    """
+
+    body = BODY_PATTERN.search(raw)
+
+    if body is None:
+        return None
+
+    lang = attributes(body.group(0)).get(b"xml:lang")
+
+    if lang is None:
+        language = LANGUAGE_PATTERN.search(raw)
+
+        if language is None:
+            return None
+
+        lang = attributes(language.group(0)).get(b"ident")
+
+    if lang is None:
+        return None
+
+    # Only ever compared with ASCII codes, so a value in
+    # another encoding can simply be replaced.
+    lang = lang.decode("utf-8", errors="replace")
+
+    return LANGUAGES.get(lang, lang)
+
+
+def element_end(raw, name: bytes, start: int) -> int:
+    """
+    Return the offset of the end tag that closes the `name`
+    element whose start tag ends at `start`, counting nested
+    elements with the same name, or -1 if there is none.
+    """
+
+    tags = re.compile(
+        b"<(/?)" + re.escape(name) + rb"(?=[\s/>])(?:[^>\"']|\"[^\"]*\"|'[^']*')*?(/?)>"
+    )
+    depth = 1
+
+    for tag in tags.finditer(raw, start):
+        if tag.group(1):
+            depth -= 1
+
+            if depth == 0:
+                return tag.start()
+        elif not tag.group(2):
+            depth += 1
+
+    return -1
+
+
+def needs_bibl_refs(raw) -> bool:
+    """
+    `add_ref_to_bibls()` sets the `@ref` of every `<bibl>` with an `@n`
+    to `convert_citation(@n)`, so it has work to do wherever the two
+    disagree, including `@ref`s derived before `URN_SUBSTITUTIONS`
+    knew the cited work.
+    """
+
+    for start_tag in BIBL_START_TAG_PATTERN.finditer(raw):
+        bibl = attributes(start_tag.group(0))
+        n = bibl.get(b"n")
+
+        if n is None:
+            continue
+
+        ref = convert_citation(n.decode("utf-8", errors="replace"))
+
+        if bibl.get(b"ref") != ref.encode("utf-8"):
+            return True
+
+    return False
+
+
+def needs_body_lang_and_urn(raw) -> bool:
+    """
+    `add_lang_and_urn_to_body_and_first_div()` has nothing to do
+    once `<body>` has both `@n` and `@xml:lang` and the first
+    `<div>` after it already carries the same values.
+    """
+
+    body = BODY_PATTERN.search(raw)
+
+    if body is None:
+        return False
+
+    body_attributes = attributes(body.group(0))
+    n = body_attributes.get(b"n")
+    lang = body_attributes.get(b"xml:lang")
+
+    if n is None or lang is None:
+        return True
+
+    div = DIV_PATTERN.search(raw, body.end())
+
+    if div is None:
+        return True
+
+    div_attributes = attributes(div.group(0))
+    decoded = lang.decode("utf-8", errors="replace")
+    fixed_lang = LANGUAGES.get(decoded, decoded)
+
+    return (
+        div_attributes.get(b"n") != n
+        or div_attributes.get(b"xml:lang") != fixed_lang.encode("utf-8")
+        or fixed_lang.encode("utf-8") != lang
+    )
+
+
+def needs_betacode_conversion(raw) -> bool:
+    """
+    `convert_betacode_to_unicode()` only changes the text of Greek
+    elements that still contains characters used by Betacode. Each
+    outermost Greek element is walked once; the walk covers the
+    Greek elements nested in it as well.
+    """
+
+    start_tag = GREEK_START_TAG_PATTERN.search(raw)
+
+    while start_tag is not None:
+        if start_tag.group(2) == b"/":
+            start_tag = GREEK_START_TAG_PATTERN.search(raw, start_tag.end())
+            continue
+
+        end = element_end(raw, start_tag.group(1), start_tag.end())
+
+        if end == -1:
+            return True
+
+        if greek_content_changes(raw[start_tag.end() : end]):
+            return True
+
+        start_tag = GREEK_START_TAG_PATTERN.search(raw, end)
+
+    return False
+
+
+def greek_content_changes(content) -> bool:
+    """
+    Walk the content of a Greek element the way
+    `convert_betacode_to_unicode()` does, and tell whether any of
+    the text that the pass rewrites would change: the element's own
+    text, its descendants' text, and the tails of children whose
+    parent is explicitly Greek or English. Greek descendants are
+    checked as the pass would convert them on their own, too.
+    """
+
+    # Each open element is a `(greek, english)` pair for its
+    # own `@lang`; the first one is the Greek element itself.
+    stack = [(True, False)]
+    position = 0
+    # What the text at `position` belongs to: the text of the
+    # element on top of the stack, or the tail of one of its children.
+    kind = "text"
+
+    def changes(segment) -> bool:
+        segment = ENTITY_REFERENCE_PATTERN.sub(b"", segment)
+
+        if kind == "text":
+            english = stack[-1][1]
+            parent_english = len(stack) > 1 and stack[-2][1]
+
+            if len(stack) > 1 and (english or parent_english):
+                # Rewritten with `uni_to_beta()`, which only
+                # touches non-ASCII characters, and then again
+                # with `beta_to_uni()` if the element is Greek.
+                if NON_ASCII_PATTERN.search(segment):
+                    return True
+
+                if not stack[-1][0]:
+                    return False
+
+            return BETACODE_PATTERN.search(segment) is not None
+
+        greek, english = stack[-1]
+
+        if greek:
+            return BETACODE_PATTERN.search(segment) is not None
+
+        if english:
+            # The pass replaces these tails with the child's
+            # text, unless they are only whitespace.
+            return len(segment.strip(XML_WHITESPACE.encode("utf-8"))) > 0
+
+        return False
+
+    for node in NODE_PATTERN.finditer(content):
+        if changes(content[position : node.start()]):
+            return True
+
+        position = node.end()
+
+        if node.group(0).startswith(b"<![CDATA["):
+            return True
+
+        if node.group(1) is not None:
+            # Comments are descendants too, and their text is converted.
+            if BETACODE_PATTERN.search(node.group(1)):
+                return True
+            kind = "tail"
+            continue
+
+        if node.group(0).startswith(b"<?"):
+            kind = "tail"
+            continue
+
+        closing, attributes_, self_closing = node.group(2, 3, 4)
+
+        if closing:
+            stack.pop()
+
+            if len(stack) == 0:
+                return False
+
+            kind = "tail"
+        elif self_closing:
+            kind = "tail"
+        else:
+            stack.append(
+                (
+                    GREEK_LANG_PATTERN.search(attributes_) is not None,
+                    ENGLISH_LANG_PATTERN.search(attributes_) is not None,
+                )
+            )
+            kind = "text"
+
+    return changes(content[position:])
+
+
+def scan(filename: str) -> Plan:
+    """
+    Memory-map `filename` and build its `Plan` without
+    reading it into a Python string.
+    """
+
+    with open(filename, "rb") as f:
+        try:
+            raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return scan_bytes(b"")
+
+        with raw:
+            return scan_bytes(raw)
+
+
+def scan_bytes(raw) -> Plan:
+    """
+    Check `raw` for the markup that each pass reacts to. The
+    triggers err on the side of running a pass: a false positive
+    costs a little time, but a false negative would leave the
+    document half-converted.
+    """
+
+    passes = set()
+
+    for name, pattern in PASS_TRIGGERS.items():
+        if pattern.search(raw):
+            passes.add(name)
+
+    if needs_bibl_refs(raw):
+        passes.add("add_ref_to_bibls")
+
+    if needs_body_lang_and_urn(raw):
+        passes.add("add_lang_and_urn_to_body_and_first_div")
+
+        # `<body>` and its first `<div>` are about to become Greek,
+        # so everything in them may have to be converted.
+        if derived_body_lang(raw) == "grc":
+            passes.add("convert_betacode_to_unicode")
+
+    if needs_betacode_conversion(raw):
+        passes.add("convert_betacode_to_unicode")
+
+    for name, dependencies in PASS_DEPENDENCIES.items():
+        if name in passes:
+            passes.update(dependencies)
+
+    return Plan(
+        passes,
+        entities=ENTITY_PATTERN.search(raw) is not None,
+        bibls=BIBL_PATTERN.search(raw) is not None,
+    )
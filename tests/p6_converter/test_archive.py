@@ -0,0 +1,102 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from src.p6_converter.archive import archive_format, convert_archive, iter_members
+
+FIXTURE = "tests/viaf000.viaf001.test_file.xml"
+
+LATIN_1 = b'<?xml version="1.0" encoding="ISO-8859-1"?><TEI><text><body xml:lang="fran\xe7ais"/></text></TEI>'
+
+
+@pytest.fixture
+def source_xml():
+    with open(FIXTURE, "rb") as f:
+        return f.read()
+
+
+class TestArchive:
+    def test_archive_format(self):
+        assert archive_format("corpus.zip") == "zip"
+        assert archive_format("corpus.tar.gz") == "tar.gz"
+        assert archive_format("corpus.tgz") == "tar.gz"
+        assert archive_format("corpus.tar") == "tar"
+        assert archive_format("corpus.xml") is None
+
+    def test_convert_zip_to_tar_gz(self, tmp_path, source_xml):
+        source = tmp_path / "corpus.zip"
+        destination = tmp_path / "converted.tar.gz"
+
+        with zipfile.ZipFile(source, "w") as archive:
+            archive.writestr("data/viaf000.viaf001.test_file.xml", source_xml)
+            archive.writestr("data/README.txt", b"not xml")
+
+        assert convert_archive(str(source), str(destination), compresslevel=1) == 2
+
+        members = {info.name: data for info, data in iter_members(str(destination))}
+
+        assert members["data/README.txt"] == b"not xml"
+        assert b"<docAuthor>" in members["data/viaf000.viaf001.test_file.xml"]
+        assert b"&Amacr;" not in members["data/viaf000.viaf001.test_file.xml"]
+
+    def test_failed_members_are_copied_unchanged(self, tmp_path):
+        source = tmp_path / "corpus.tar"
+        destination = tmp_path / "converted.zip"
+
+        with tarfile.open(source, "w") as archive:
+            broken = tmp_path / "broken.xml"
+            broken.write_bytes(b"<TEI>")
+            archive.add(broken, arcname="broken.xml")
+
+            latin = tmp_path / "latin.xml"
+            latin.write_bytes(LATIN_1)
+            archive.add(latin, arcname="latin.xml")
+
+        convert_archive(str(source), str(destination))
+
+        with zipfile.ZipFile(destination) as archive:
+            assert archive.read("broken.xml") == b"<TEI>"
+            assert archive.read("latin.xml") == LATIN_1
+
+    def test_directories_and_links_are_kept(self, tmp_path, source_xml):
+        source = tmp_path / "corpus.tar"
+        destination = tmp_path / "converted.tar"
+
+        with tarfile.open(source, "w") as archive:
+            directory = tarfile.TarInfo("data")
+            directory.type = tarfile.DIRTYPE
+            archive.addfile(directory)
+
+            member = tarfile.TarInfo("data/viaf000.viaf001.test_file.xml")
+            member.size = len(source_xml)
+            archive.addfile(member, io.BytesIO(source_xml))
+
+            link = tarfile.TarInfo("latest.xml")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "data/viaf000.viaf001.test_file.xml"
+            archive.addfile(link)
+
+        assert convert_archive(str(source), str(destination)) == 3
+
+        with tarfile.open(destination) as archive:
+            members = {info.name: info for info in archive.getmembers()}
+
+        assert members["data"].isdir()
+        assert members["latest.xml"].issym()
+        assert members["latest.xml"].linkname == "data/viaf000.viaf001.test_file.xml"
+
+        # A zip archive keeps the directory but cannot hold the link.
+        zipped = tmp_path / "converted.zip"
+        convert_archive(str(source), str(zipped))
+
+        with zipfile.ZipFile(zipped) as archive:
+            assert archive.namelist() == ["data/", "data/viaf000.viaf001.test_file.xml"]
+
+        # Zip directories survive a zip-to-zip conversion.
+        rezipped = tmp_path / "reconverted.zip"
+        convert_archive(str(zipped), str(rezipped))
+
+        with zipfile.ZipFile(rezipped) as archive:
+            assert archive.getinfo("data/").is_dir()
@@ -0,0 +1,203 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+import src.p6_converter.batch as batch
+from src.p6_converter.batch import (
+    MemoryBudget,
+    corpus_rate,
+    estimate_cost,
+    makespan_lower_bound,
+    run_batch,
+    schedule,
+)
+
+FIXTURE = "tests/viaf000.viaf001.test_file.xml"
+
+convert_timed = batch.convert_timed
+
+schedule_files = batch.schedule
+
+
+def dying_convert_timed(filename, *args):
+    if "dying" in filename:
+        os._exit(1)
+
+    return convert_timed(filename, *args)
+
+
+def failing_write_from(*args):
+    raise RuntimeError("disk on fire")
+
+
+def failing_schedule(filenames, history=None):
+    yield from schedule_files(filenames, history)
+    raise RuntimeError("lost the file list")
+
+
+def copies(tmp_path, n):
+    filenames = []
+
+    for i in range(n):
+        filename = tmp_path / f"viaf000.viaf00{i}.test_file.xml"
+        shutil.copy(FIXTURE, filename)
+        filenames.append(str(filename))
+
+    return filenames
+
+
+class TestBatch:
+    def test_run_batch(self, tmp_path):
+        filenames = []
+
+        for i in range(4):
+            filename = tmp_path / f"viaf000.viaf00{i}.test_file.xml"
+            shutil.copy(FIXTURE, filename)
+            filenames.append(str(filename))
+
+        broken = tmp_path / "broken.xml"
+        broken.write_bytes(b"<TEI><byline>")
+        filenames.append(str(broken))
+
+        unchanged = tmp_path / "unchanged.xml"
+        unchanged.write_bytes(b"<TEI/>")
+
+        report = run_batch(
+            filenames + [str(unchanged)], workers=2, memory_budget=1, prefetch=1
+        )
+
+        assert report.failed == [str(broken)]
+        assert report.unchanged == 1
+        assert report.prefetch.items == 6
+        assert report.convert.items == 5
+        assert report.write.items == 4
+        assert report.write.max_queue_depth >= 1
+
+        for filename in filenames[:-1]:
+            with open(filename, "rb") as f:
+                assert b"<docAuthor>" in f.read()
+
+        assert broken.read_bytes() == b"<TEI><byline>"
+        assert unchanged.read_bytes() == b"<TEI/>"
+
+    def test_memory_budget_blocks_until_released(self):
+        budget = MemoryBudget(10)
+        budget.acquire(8)
+
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(8)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+
+        assert not acquired.wait(0.05)
+
+        budget.release(8)
+        thread.join()
+
+        assert acquired.is_set()
+        assert budget.peak == 8
+
+    def test_schedule_is_largest_first(self, tmp_path):
+        small = tmp_path / "small.xml"
+        large = tmp_path / "large.xml"
+        small.write_bytes(b"x")
+        large.write_bytes(b"x" * 100)
+
+        assert [f for f, _ in schedule([str(small), str(large)])] == [
+            str(large),
+            str(small),
+        ]
+
+        # A small file that was slow last time goes first.
+        history = {str(small): {"bytes": 1000, "seconds": 10.0}}
+
+        assert [f for f, _ in schedule([str(small), str(large)], history)] == [
+            str(small),
+            str(large),
+        ]
+
+    def test_estimate_cost_uses_history(self):
+        history = {"a.xml": {"bytes": 100, "seconds": 2.0}}
+
+        assert estimate_cost("a.xml", 5, history) == 2.0
+        assert estimate_cost("b.xml", 50, history) == 1.0
+        assert estimate_cost("b.xml", 50) == 50.0
+        assert estimate_cost("b.xml", 50, history, rate=0.1) == 5.0
+        assert corpus_rate(history) == 0.02
+        assert corpus_rate({}) is None
+
+    def test_makespan_lower_bound(self):
+        assert makespan_lower_bound([], 2) == 0.0
+        assert makespan_lower_bound([4.0, 1.0, 1.0], 2) == 4.0
+        assert makespan_lower_bound([2.0, 2.0, 2.0, 2.0], 2) == 4.0
+
+    def test_pool_is_recycled_when_workers_grow(self, tmp_path):
+        filenames = []
+
+        for i in range(3):
+            filename = tmp_path / f"viaf000.viaf00{i}.test_file.xml"
+            shutil.copy(FIXTURE, filename)
+            filenames.append(str(filename))
+
+        # With no room in the memory budget, each file is only read
+        # once the previous one is written, by which time its worker
+        # has asked for the pool to be recycled.
+        report = run_batch(
+            filenames, workers=1, memory_budget=1, prefetch=1, max_worker_rss=0
+        )
+
+        assert report.recycled_pools >= 1
+        assert report.write.items == 3
+        assert report.failed == []
+        assert report.makespan_lower_bound > 0
+
+    def test_dead_worker_does_not_hang_the_batch(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(batch, "convert_timed", dying_convert_timed)
+
+        # The largest file goes first, so the pool breaks before
+        # the other files are submitted.
+        dying = tmp_path / "dying.xml"
+        dying.write_bytes(open(FIXTURE, "rb").read() + b" " * 4096)
+        filenames = [str(dying)]
+
+        for i in range(3):
+            filename = tmp_path / f"viaf000.viaf00{i}.test_file.xml"
+            shutil.copy(FIXTURE, filename)
+            filenames.append(str(filename))
+
+        report = run_batch(filenames, workers=1, prefetch=1)
+
+        assert str(dying) in report.failed
+        assert report.write.items + len(report.failed) == 4
+
+    def test_unchanged_output_is_not_written(self, tmp_path):
+        filename = tmp_path / "viaf000.viaf001.test_file.xml"
+        shutil.copy(FIXTURE, filename)
+        run_batch([str(filename)], workers=1)
+        converted = filename.read_bytes()
+
+        # Without the pre-scan every pass runs, but nothing changes.
+        report = run_batch([str(filename)], workers=1, prescan=False)
+
+        assert report.convert.items == 1
+        assert report.write.items == 0
+        assert filename.read_bytes() == converted
+
+    def test_failing_prefetch_stage_is_raised(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(batch, "schedule", failing_schedule)
+
+        with pytest.raises(RuntimeError, match="lost the file list"):
+            run_batch(copies(tmp_path, 3), workers=1, prefetch=1)
+
+    def test_failing_write_stage_is_raised(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(batch, "write_from", failing_write_from)
+
+        # Enough files to fill the write queue behind the dead writer.
+        with pytest.raises(RuntimeError, match="disk on fire"):
+            run_batch(copies(tmp_path, 8), workers=1, prefetch=1)
@@ -0,0 +1,119 @@
+import shutil
+import sqlite3
+
+import pytest
+
+from src.p6_converter.batch import run_batch
+from src.p6_converter.citations import CitationIndex
+from src.p6_converter.converter import load_source
+
+FIXTURE = "tests/viaf000.viaf001.test_file.xml"
+
+DOCUMENT = "urn:cts:greekLit:viaf000.viaf001.test_file"
+
+TARGET = "urn:cts:greekLit:tlg0011.tlg007:437"
+
+
+def locked_update(self, filename, citations):
+    raise sqlite3.OperationalError("database is locked")
+
+
+class TestCitations:
+    def test_find_citations(self):
+        with open(FIXTURE, "rb") as f:
+            converter = load_source(FIXTURE, f.read())
+
+        converter.convert(write=False)
+
+        assert converter.find_citations() == [(DOCUMENT, "1", TARGET)]
+
+    def test_cited_by(self, tmp_path):
+        with CitationIndex(str(tmp_path / "citations.db")) as index:
+            index.update("a.xml", [("urn:a", "1.2", TARGET), ("urn:a", "3", f"{TARGET}-440")])
+            index.update("b.xml", [("urn:b", "", "urn:cts:greekLit:tlg0011.tlg004:1")])
+
+            assert index.cited_by(TARGET, exact=True) == [("urn:a", "1.2", TARGET, "a.xml")]
+            assert len(index.cited_by(TARGET)) == 2
+            assert len(index.cited_by("urn:cts:greekLit:tlg0011")) == 3
+            assert len(index.cited_by("urn:cts:greekLit:")) == 3
+
+            # Only whole URN components match.
+            index.update("c.xml", [("urn:c", "", f"{TARGET}0"), ("urn:c", "", f"{TARGET}.1")])
+
+            assert [row[2] for row in index.cited_by(TARGET)] == [
+                TARGET,
+                f"{TARGET}-440",
+                f"{TARGET}.1",
+            ]
+            assert index.cited_by("urn:cts:greekLit:tlg00") == []
+
+            index.update("c.xml", [])
+
+            index.update("a.xml", [])
+
+            assert index.cited_by(TARGET) == []
+
+    def test_batch_indexes_converted_and_unchanged_files(self, tmp_path):
+        filename = tmp_path / "viaf000.viaf001.test_file.xml"
+        shutil.copy(FIXTURE, filename)
+        index = str(tmp_path / "citations.db")
+
+        report = run_batch([str(filename)], workers=1, index=index)
+
+        assert report.indexed == 1
+
+        # The second time around the file needs no changes,
+        # but its citations are still indexed.
+        converted = filename.read_bytes()
+        report = run_batch([str(filename)], workers=1, index=index)
+
+        assert report.write.items == 0
+        assert report.indexed == 1
+        assert filename.read_bytes() == converted
+
+        with CitationIndex(index) as citations:
+            assert citations.cited_by(TARGET) == [(DOCUMENT, "1", TARGET, str(filename))]
+
+    def test_indexing_only_still_recycles_the_pool(self, tmp_path):
+        filenames = []
+
+        for i in range(3):
+            filename = tmp_path / f"viaf000.viaf00{i}.test_file.xml"
+            shutil.copy(FIXTURE, filename)
+            filenames.append(str(filename))
+
+        index = str(tmp_path / "citations.db")
+        run_batch(filenames, workers=1, index=index)
+
+        # Now the files are only parsed for their citations.
+        report = run_batch(
+            filenames,
+            workers=1,
+            memory_budget=1,
+            prefetch=1,
+            max_worker_rss=0,
+            index=index,
+        )
+
+        assert report.write.items == 0
+        assert report.indexed == 3
+        assert report.recycled_pools >= 1
+
+    def test_batch_with_unusable_index_fails_fast(self, tmp_path):
+        filename = tmp_path / "viaf000.viaf001.test_file.xml"
+        shutil.copy(FIXTURE, filename)
+
+        with pytest.raises(sqlite3.OperationalError):
+            run_batch([str(filename)], workers=1, index=str(tmp_path / "missing" / "x.db"))
+
+        assert filename.read_bytes() == open(FIXTURE, "rb").read()
+
+    def test_batch_reports_files_it_could_not_index(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(CitationIndex, "update", locked_update)
+        filename = tmp_path / "viaf000.viaf001.test_file.xml"
+        shutil.copy(FIXTURE, filename)
+
+        report = run_batch([str(filename)], workers=1, index=str(tmp_path / "citations.db"))
+
+        assert report.failed == [str(filename)]
+        assert report.indexed == 0
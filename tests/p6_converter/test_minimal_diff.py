@@ -0,0 +1,108 @@
+import lxml.etree as etree
+
+from src.p6_converter.converter import Converter, convert_source, load_source
+from src.p6_converter.minimal_diff import element_spans, first_difference
+
+FIXTURE = "tests/viaf000.viaf001.test_file.xml"
+
+LIGHTLY_TOUCHED = """<?xml version='1.0' encoding='utf-8'?>
+<!-- formatting below is deliberately irregular -->
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+  <teiHeader><encodingDesc><refsDecl n="CTS"/></encodingDesc></teiHeader>
+  <text>
+    <body   n="urn:cts:greekLit:viaf000.viaf001" xml:lang="eng">
+      <div n="urn:cts:greekLit:viaf000.viaf001" xml:lang="eng">
+        <p>Untouched &amp; <hi rend="italic">verbatim</hi>.</p>
+        <p><byline>R. C. Jebb</byline></p>
+        <p targOrder="U" n="1">Attributes</p>
+      </div>
+    </body>
+  </text>
+</TEI>
+"""
+
+
+def normalized(raw: bytes) -> bytes:
+    tree = etree.fromstring(raw, etree.XMLParser(remove_blank_text=True))
+    etree.indent(tree)
+    return etree.tostring(tree)
+
+
+class TestMinimalDiff:
+    def test_element_spans(self):
+        raw = b'<a><!-- <b> --><b x=">"/><c>text</c></a>'
+        spans = element_spans(raw)
+
+        assert [name for name, _ in spans] == [b"a", b"b", b"c"]
+        assert raw[spans[1][1].start : spans[1][1].end] == b'<b x=">"/>'
+        assert raw[spans[2][1].start : spans[2][1].end] == b"<c>text</c>"
+
+    def test_output_matches_full_serialization(self):
+        with open(FIXTURE, "rb") as f:
+            raw = f.read()
+
+        assert normalized(convert_source(FIXTURE, raw, minimal_diff=True)) == normalized(
+            convert_source(FIXTURE, raw)
+        )
+
+        # Blank tails are kept when minimal_diff is set, and
+        # must not be rewritten by the Betacode pass.
+        raw = LIGHTLY_TOUCHED.replace(
+            "<p><byline>",
+            '<p xml:lang="grc">kai <foreign xml:lang="eng"><hi>x</hi>\n</foreign></p>\n<p><byline>',
+        ).encode("utf-8")
+
+        assert normalized(convert_source(FIXTURE, raw, minimal_diff=True)) == normalized(
+            convert_source(FIXTURE, raw)
+        )
+
+    def test_only_changed_regions_are_rewritten(self):
+        output = convert_source(
+            "viaf000.viaf001.xml", LIGHTLY_TOUCHED.encode("utf-8"), minimal_diff=True
+        ).decode("utf-8")
+
+        expected = (
+            LIGHTLY_TOUCHED.replace("<byline>R. C. Jebb</byline>", "<docAuthor>R. C. Jebb</docAuthor>")
+            .replace('<p targOrder="U" n="1">', '<p n="1">')
+        )
+
+        assert output == expected
+
+    def test_untouched_file_is_not_written(self, tmp_path):
+        filename = tmp_path / "viaf000.viaf001.xml"
+        filename.write_text(LIGHTLY_TOUCHED.replace("byline", "docAuthor").replace(' targOrder="U"', ""))
+        before = filename.read_bytes()
+
+        converter = Converter(str(filename), minimal_diff=True)
+        converter.convert()
+
+        assert converter.find_patches() == []
+        assert filename.read_bytes() == before
+
+    def test_patches_are_written_in_place(self, tmp_path):
+        filename = tmp_path / "viaf000.viaf001.xml"
+        filename.write_text(LIGHTLY_TOUCHED)
+
+        Converter(str(filename), minimal_diff=True).convert()
+
+        assert "<docAuthor>R. C. Jebb</docAuthor>" in filename.read_text()
+        assert filename.read_text().startswith(LIGHTLY_TOUCHED.split("<byline>")[0])
+
+    def test_line_endings_are_kept(self, tmp_path):
+        filename = tmp_path / "viaf000.viaf001.xml"
+        raw = LIGHTLY_TOUCHED.replace("\n", "\r\n").replace("Untouched", "&aacute;Untouched").encode("utf-8")
+        filename.write_bytes(raw)
+
+        load_source(str(filename), raw, minimal_diff=True).convert()
+
+        output = filename.read_bytes()
+
+        assert b"<docAuthor>R. C. Jebb</docAuthor>" in output
+        assert output.count(b"\r\n") == raw.count(b"\r\n")
+        assert b"\n" not in output.replace(b"\r\n", b"")
+
+    def test_first_difference(self):
+        assert first_difference(b"abc", b"abc") == 3
+        assert first_difference(b"abc", b"abd") == 2
+        assert first_difference(b"ab", b"abc") == 2
+        assert first_difference(b"x" * 100000 + b"a", b"x" * 100000 + b"b") == 100000
@@ -0,0 +1,115 @@
+from src.p6_converter.converter import convert_source
+from src.p6_converter.prescan import scan, scan_bytes
+
+FIXTURE = "tests/viaf000.viaf001.test_file.xml"
+
+CONVERTED = b"""<?xml version='1.0' encoding='utf-8'?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+	<teiHeader><encodingDesc><refsDecl n="CTS"/></encodingDesc></teiHeader>
+	<text>
+		<body n="urn:cts:greekLit:viaf000.viaf001" xml:lang="eng">
+			<div type="commentary" n="urn:cts:greekLit:viaf000.viaf001" xml:lang="eng">
+				<p><app><lem xml:lang="grc">\xce\xba\xce\xb1\xe1\xbd\xb6</lem></app> Cf. <bibl n="Soph. OC 437" ref="urn:cts:greekLit:tlg0011.tlg007:437">OC 437</bibl></p>
+				<date when="-0044">44 BC</date>
+			</div>
+		</body>
+	</text>
+</TEI>
+"""
+
+
+class TestPrescan:
+    def test_converted_document_has_empty_plan(self):
+        assert scan_bytes(CONVERTED).empty
+
+    def test_triggers(self):
+        plan = scan(FIXTURE)
+
+        assert plan.entities
+        assert "convert_bylines" in plan.passes
+        assert "convert_lemma_to_applemma" in plan.passes
+        assert "convert_betacode_to_unicode" in plan.passes
+        assert "assign_refable_units" in plan.passes
+        assert "convert_argument_tags" not in plan.passes
+        assert "remove_targOrder_attr" not in plan.passes
+
+    def test_betacode_trigger(self):
+        betacode = CONVERTED.replace("καὶ".encode("utf-8"), b"kai\\")
+
+        assert scan_bytes(betacode).passes == {"convert_betacode_to_unicode"}
+
+    def test_betacode_after_nested_element(self):
+        raw = CONVERTED.replace(
+            "<lem xml:lang=\"grc\">καὶ</lem>".encode("utf-8"),
+            "<p xml:lang=\"grc\">καὶ <persName>Σ</persName> kai\\</p>".encode("utf-8"),
+        )
+        plan = scan_bytes(raw)
+
+        assert "convert_betacode_to_unicode" in plan.passes
+        assert convert_source(FIXTURE, raw, skip=plan.skip()) == convert_source(FIXTURE, raw)
+
+    def test_betacode_in_greek_nested_in_english(self):
+        raw = CONVERTED.replace(
+            "<lem xml:lang=\"grc\">καὶ</lem>".encode("utf-8"),
+            "<p xml:lang=\"grc\">καὶ <foreign xml:lang=\"eng\">see <q xml:lang=\"grc\">kai\\</q></foreign></p>".encode("utf-8"),
+        )
+        plan = scan_bytes(raw)
+
+        assert "convert_betacode_to_unicode" in plan.passes
+        assert convert_source(FIXTURE, raw, skip=plan.skip()) == convert_source(FIXTURE, raw)
+
+    def test_betacode_in_body_that_becomes_greek(self):
+        raw = b"""<TEI xmlns="http://www.tei-c.org/ns/1.0">
+	<teiHeader>
+		<encodingDesc><refsDecl n="CTS"/></encodingDesc>
+		<profileDesc><langUsage><language ident="greek">Greek</language></langUsage></profileDesc>
+	</teiHeader>
+	<text><body><div><p>kai\\</p></div></body></text>
+</TEI>
+"""
+        plan = scan_bytes(raw)
+
+        assert "convert_betacode_to_unicode" in plan.passes
+        assert convert_source(FIXTURE, raw, skip=plan.skip()) == convert_source(FIXTURE, raw)
+
+    def test_converted_fixture_needs_no_changes(self):
+        with open(FIXTURE, "rb") as f:
+            converted = convert_source(FIXTURE, f.read())
+
+        # Tails of children of non-Greek elements, like "Cf." here,
+        # are left alone by the Betacode pass.
+        assert b"Cf." in converted
+        assert scan_bytes(converted).empty
+
+    def test_lang_in_another_encoding(self):
+        raw = b'<?xml version="1.0" encoding="ISO-8859-1"?><TEI><text><body xml:lang="fran\xe7ais"/></text></TEI>'
+
+        assert "add_lang_and_urn_to_body_and_first_div" in scan_bytes(raw).passes
+
+    def test_stale_bibl_ref_trigger(self):
+        stale = CONVERTED.replace(b'ref="urn:cts:greekLit:tlg0011.tlg007:437"', b'ref="Soph. OC 437"')
+        plan = scan_bytes(stale)
+
+        assert plan.passes == {"add_ref_to_bibls"}
+        assert convert_source(FIXTURE, stale, skip=plan.skip()) == convert_source(FIXTURE, stale)
+        assert b'ref="urn:cts:greekLit:tlg0011.tlg007:437"' in convert_source(FIXTURE, stale)
+
+    def test_date_trigger(self):
+        assert "convert_dates" in scan_bytes(b'<date when="-44"/>').passes
+        assert "convert_dates" not in scan_bytes(b'<date when="-0044"/>').passes
+
+    def test_skipping_passes_does_not_change_output(self):
+        with open(FIXTURE, "rb") as f:
+            raw = f.read()
+
+        plan = scan_bytes(raw)
+
+        assert convert_source(FIXTURE, raw, skip=plan.skip()) == convert_source(
+            FIXTURE, raw
+        )
+
+    def test_empty_file(self, tmp_path):
+        empty = tmp_path / "empty.xml"
+        empty.write_bytes(b"")
+
+        assert scan(str(empty)).empty